@@ -1,5 +1,9 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import custom_logger
 from dotenv import load_dotenv
 
@@ -10,55 +14,126 @@ FLARE_HEADERS = {'Content-Type': 'application/json'}
 
 logger = custom_logger.create_logger('GET HTML CONTENT')
 
+REQUEST_ATTEMPTS = 5
 
-def get_request(url: str, timeout: int = 20):
+# Shared session so repeated requests to the same host reuse connections,
+# failed requests are retried by urllib3 with exponential backoff
+_session = requests.Session()
+_retry = Retry(total=REQUEST_ATTEMPTS - 1,
+               backoff_factor=0.5,
+               status_forcelist=(429, 500, 502, 503, 504),
+               allowed_methods=frozenset(['GET', 'POST']),
+               raise_on_status=False)
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=_retry)
+_session.mount('http://', _adapter)
+_session.mount('https://', _adapter)
+
+
+def get_session() -> requests.Session:
+    return _session
+
+
+def get_request(url: str, timeout: int = 20, stream: bool = False):
     try:
-        response = requests.get(url, timeout=timeout)
+        response = _session.get(url, timeout=timeout, stream=stream)
         return response
     except requests.exceptions.ConnectionError as e:
-        logger.error(f'Connection error {e}')
+        logger.error('Connection error %s', e)
     except requests.exceptions.InvalidSchema:
-        logger.error(f'Check protocol of "{url}"')
+        logger.error('Check protocol of "%s"', url)
+    except requests.exceptions.RequestException as e:
+        # Timeouts or retries exhausted, only this request fails
+        logger.error('Request error on %s: %s', url, e)
 
 
 def get_request_flaresolver(url: str, timeout: int = 20, flaresolver_url: str = FLARESOLVER_URL):
-    logger.debug(f'FLARESOLVER_URL: {flaresolver_url}')
+    logger.debug('FLARESOLVER_URL: %s', flaresolver_url)
     try:
-        response = requests.post(flaresolver_url, headers=FLARE_HEADERS, json={
+        response = _session.post(flaresolver_url, headers=FLARE_HEADERS, json={
             'cmd': 'request.get', 'url': url, 'maxTimeout': timeout*1000},
             timeout=timeout)
         return response
     except requests.exceptions.ConnectionError:
-        logger.error(f'Connection error, check FlareSolver host: {
-                     flaresolver_url}')
+        logger.error('Connection error, check FlareSolver host: %s', flaresolver_url)
     except requests.exceptions.InvalidSchema:
-        logger.error(f'Check FlareSolver host "{flaresolver_url}"')
+        logger.error('Check FlareSolver host "%s"', flaresolver_url)
+    except requests.exceptions.RequestException as e:
+        logger.error('FlareSolver request error on %s: %s', url, e)
 
 
-def get_html_content(url: str, attempts: int = 5, flaresolver: bool = True, flaresolver_url: str = FLARESOLVER_URL):
-    for _ in range(attempts):
-        response = get_request(url, timeout=20)
-        if not response:
-            continue
-        if not response.ok:
-            logger.error(f'Response with errors from {url}')
-            continue
-        return response.text
+def get_html_content(url: str, flaresolver: bool = True, flaresolver_url: str = FLARESOLVER_URL):
+    response = get_request(url, timeout=20)
+    if response is not None:
+        if response.ok:
+            return response.text
+        logger.error('Response with errors from %s', url)
 
     if not flaresolver:
         return
-    logger.debug(f'Trying with Flaresolver for {url}')
-    for _ in range(attempts):
-        response = get_request_flaresolver(
-            url, timeout=20, flaresolver_url=flaresolver_url)
-        if not response:
-            continue
-        if not response.ok:
-            logger.error(f'Response with errors from {url}')
-            continue
+    return get_html_content_flaresolver(url, flaresolver_url=flaresolver_url)
+
+
+def get_html_content_flaresolver(url: str, flaresolver_url: str = FLARESOLVER_URL):
+    logger.debug('Trying with Flaresolver for %s', url)
+    response = get_request_flaresolver(
+        url, timeout=20, flaresolver_url=flaresolver_url)
+    if response is None:
+        return
+    if not response.ok:
+        logger.error('Response with errors from %s', url)
+        return
+    try:
         response_json = response.json()
-        if not 'solution' in response_json:
-            continue
-        if not 'response' in response_json['solution']:
-            continue
-        return response_json['solution']['response']
+    except ValueError:
+        logger.error('FlareSolver response is not a valid json for %s', url)
+        return
+    if not 'solution' in response_json:
+        return
+    if not 'response' in response_json['solution']:
+        return
+    return response_json['solution']['response']
+
+
+def stream_html_content(url: str, flaresolver: bool = True, flaresolver_url: str = FLARESOLVER_URL):
+    # Iterator of the decoded html by chunks, the whole page is never held in memory
+    response = get_request(url, timeout=20, stream=True)
+    if response is not None:
+        if response.ok and response.encoding:
+            return _iter_response_text(response)
+        if response.ok:
+            # Without a declared encoding requests has to guess it from the whole content
+            content = response.text
+            response.close()
+            return iter([content])
+        response.close()
+        if not flaresolver:
+            # Without the fallback the caller expects some requests to fail
+            logger.debug('Response with status %s from %s', response.status_code, url)
+            return
+        logger.error('Response with errors from %s', url)
+
+    if not flaresolver:
+        return
+    content = get_html_content_flaresolver(url, flaresolver_url=flaresolver_url)
+    if content:
+        return iter([content])
+
+
+def _iter_response_text(response: requests.Response, chunk_size: int = 65536):
+    try:
+        yield from response.iter_content(chunk_size=chunk_size, decode_unicode=True)
+    finally:
+        response.close()
+
+
+def stream_html_contents(urls: list[str], consume, max_workers: int = 8, delay: float = 0, flaresolver: bool = True, flaresolver_url: str = FLARESOLVER_URL) -> None:
+    # Each html is passed to consume(url, chunks) on the worker that requested it
+    def fetch(url: str):
+        if delay:
+            time.sleep(delay)
+        chunks = stream_html_content(url, flaresolver=flaresolver, flaresolver_url=flaresolver_url)
+        if chunks is not None:
+            consume(url, chunks)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(fetch, urls))
@@ -1,10 +1,15 @@
 import os
+import re
 import json
+from functools import lru_cache
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import custom_logger
 
-from bs4 import BeautifulSoup
+# bs4 is imported when html is parsed, to keep it out of the startup of commands that don't decode
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
 
 logger = custom_logger.create_logger('DECODE HTML')
 
@@ -14,21 +19,39 @@ DECODE_GUIDE_FILE = os.getenv('DECODE_GUIDE_FILE', f'{CURRENT_DIR}/decode_guide.
 
 XOR_SEPARATOR = "XOR"
 
-try:
-    with open(DECODE_GUIDE_FILE, 'r', encoding='UTF-8') as f:
-        DECODE_GUIDE = json.load(f)
-except FileNotFoundError:
-    logger.error(f"File {DECODE_GUIDE_FILE} not found.")
-    raise
-except PermissionError:
-    logger.error(f"Permission error {DECODE_GUIDE_FILE}.")
-    raise
-except json.JSONDecodeError:
-    logger.error(f"Json Decode error {DECODE_GUIDE_FILE}.")
-    raise
-except Exception as e:
-    logger.error(f"Error {DECODE_GUIDE_FILE}: {e}")
-    raise
+# Elements that are a tag name with an optional id and class can be searched with find_all,
+# skipping the css selector engine
+SIMPLE_ELEMENT_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9]*)(?:#([\w-]+))?(?:\.([\w-]+))?$')
+
+# Html that declares a doctype, after an optional bom, xml declaration and comments
+DOCTYPE_RE = re.compile(r'\ufeff?\s*(?:<\?xml[^>]*>\s*)?(?:<!--.*?-->\s*)*<!DOCTYPE', re.I | re.S)
+
+
+@lru_cache(maxsize=1)
+def load_decode_guide() -> dict:
+    # Loaded on the first Decoder, commands that don't decode html never read it
+    try:
+        decode_guide = json.loads(Path(DECODE_GUIDE_FILE).read_bytes())
+    except FileNotFoundError:
+        logger.error("File %s not found.", DECODE_GUIDE_FILE)
+        raise
+    except PermissionError:
+        logger.error("Permission error %s.", DECODE_GUIDE_FILE)
+        raise
+    except json.JSONDecodeError:
+        logger.error("Json Decode error %s.", DECODE_GUIDE_FILE)
+        raise
+    except Exception as e:
+        logger.error("Error %s: %s", DECODE_GUIDE_FILE, e)
+        raise
+    return {item['host']: item for item in decode_guide}
+
+
+@lru_cache(maxsize=256)
+def compile_selector(selector: str):
+    import soupsieve
+    return soupsieve.compile(selector)
+
 
 class Decoder:
     host: str
@@ -36,37 +59,147 @@ class Decoder:
 
     def __init__(self, host: str):
         self.host = host
-        self.decode_guide = self._get_element_by_key(DECODE_GUIDE, 'host', host)
+        self.decode_guide = self._get_decode_guide(host)
+        # Last parsed html and the tags parsed from it, so decoding several content types of the same html parses it once
+        self._soup_cache = (None, None, None)
+        # The decode guide of the host is fixed, so each content type gets its finder built once
+        self._finders = {content_type: self._build_finder(decoder)
+                         for content_type, decoder in self.decode_guide.items()
+                         if isinstance(decoder, dict)}
+        # Content types searched by tag name only need those tags to be parsed
+        self._simple_elements = {content_type: find_all_args[0]
+                                 for content_type, decoder in self.decode_guide.items()
+                                 if isinstance(decoder, dict)
+                                 and (find_all_args := self._get_find_all_args(decoder)) is not None}
+        # Identifies the decoding rules, html decoded with other rules is not reused
+        self.cache_key = (host, os.stat(DECODE_GUIDE_FILE).st_mtime_ns)
 
     def decode_html(self, html: str, content_type: str):
         if not content_type in self.decode_guide:
-            logger.error(f'{content_type} key does not exists on decode guide {DECODE_GUIDE_FILE} for host {self.host}')
+            logger.error('%s key does not exists on decode guide %s for host %s', content_type, DECODE_GUIDE_FILE, self.host)
             return
-        soup = BeautifulSoup(html, 'html.parser')
-        decoder = self.decode_guide[content_type]
-        elements = self._find_elements(soup, decoder)
+        soup = self._get_soup(html, [content_type])
+        elements = self._finders[content_type](soup)
         if not elements:
-            logger.warning(f'{content_type} not found on html using {DECODE_GUIDE_FILE} for host {self.host}')
+            logger.warning('%s not found on html using %s for host %s', content_type, DECODE_GUIDE_FILE, self.host)
         return elements
 
+    def decode_all(self, html: str, content_types: list[str]) -> dict:
+        # Parsed once with the tags of all the content types
+        self._get_soup(html, [content_type for content_type in content_types if content_type in self._finders])
+        return {content_type: self.decode_html(html, content_type) for content_type in content_types}
+
     def has_pagination(self, host: str = None):
         if host:
-            decode_guide = self._get_element_by_key(DECODE_GUIDE, 'host', host)
+            decode_guide = self._get_decode_guide(host)
             return decode_guide['has_pagination']
 
         return self.decode_guide['has_pagination']
     
     def clean_html(self, html: str):
-        soup = BeautifulSoup(html, 'html.parser')
-        for unwanted_tags in soup(['script', 'style', 'header', 'footer', 'link']):
-            unwanted_tags.decompose()
-        return str(soup)
-
-    def _find_elements(self, soup: BeautifulSoup, decoder: dict):
+        if not html:
+            return html
+        from lxml import etree, html as lxml_html
+        try:
+            # Parsed from bytes, lxml rejects str with an xml encoding declaration
+            tree = lxml_html.document_fromstring(html.encode('utf-8'),
+                                                 parser=lxml_html.HTMLParser(encoding='utf-8'))
+        except (etree.ParserError, ValueError) as e:
+            logger.error('Error parsing html to clean: %s', e)
+            return None
+        for unwanted_tag in tree.xpath('//script|//style|//header|//footer|//link'):
+            # Keeps the text that follows the removed tag
+            unwanted_tag.drop_tree()
+        # lxml adds a default doctype to html without one, only a declared doctype is kept
+        doctype = tree.getroottree().docinfo.doctype if DOCTYPE_RE.match(html) else None
+        return lxml_html.tostring(tree, encoding='unicode', doctype=doctype or None)
+
+    def clear_soup_cache(self):
+        self._soup_cache = (None, None, None)
+
+    def _get_soup(self, html: str, content_types: list[str]) -> 'BeautifulSoup':
+        elements = self._get_parse_only_elements(content_types)
+        cached_html, cached_elements, cached_soup = self._soup_cache
+        if cached_html is html and (cached_elements is None or (elements is not None and elements <= cached_elements)):
+            return cached_soup
+        from bs4 import BeautifulSoup, SoupStrainer
+        parse_only = SoupStrainer(list(elements)) if elements else None
+        soup = BeautifulSoup(html, 'lxml', parse_only=parse_only)
+        self._soup_cache = (html, elements, soup)
+        return soup
+
+    def _get_parse_only_elements(self, content_types: list[str]):
+        # None when any content type needs the whole document
+        elements = set()
+        for content_type in content_types:
+            element = self._simple_elements.get(content_type)
+            if element is None:
+                return None
+            elements.add(element)
+        return frozenset(elements) or None
+
+    def _build_finder(self, decoder: dict):
+        select = self._build_select(decoder)
+        extract = self._build_extract(decoder.get('extract'))
+        if decoder['array']:
+            return lambda soup: extract(select(soup))
+
+        def find_first(soup: 'BeautifulSoup'):
+            elements = extract(select(soup))
+            return elements[0] if elements else None
+        return find_first
+
+    def _build_select(self, decoder: dict):
+        find_all_args = self._get_find_all_args(decoder)
+        if find_all_args is not None:
+            element, kwargs = find_all_args
+            return lambda soup: soup.find_all(element, **kwargs)
+
+        selectors = self._build_selectors(decoder)
+        compiled_selectors = [compile_selector(selector) for selector in selectors]
+
+        def select(soup: 'BeautifulSoup'):
+            elements = []
+            for compiled_selector in compiled_selectors:
+                elements = compiled_selector.select(soup)
+                if elements:
+                    break
+            return elements
+        return select
+
+    def _build_extract(self, extract: dict):
+        if extract and extract["type"] == "attr":
+            attr_key = extract["key"]
+            return lambda elements: [element[attr_key] for element in elements if element.get(attr_key)]
+        if extract and extract["type"] == "text":
+            return lambda elements: [element.string for element in elements]
+        return lambda elements: elements
+
+    def _get_find_all_args(self, decoder: dict):
+        # (tag name, find_all kwargs) when the decoder doesn't need a css selector
+        element = decoder.get('element')
+        if decoder.get('selector') is not None or decoder.get('attributes') or not element:
+            return None
+        match = SIMPLE_ELEMENT_RE.match(element)
+        if not match:
+            return None
+        tag, element_id, element_class = match.groups()
+        _id = decoder.get('id')
+        _class = decoder.get('class')
+        if (element_id and _id) or (element_class and _class):
+            return None
+        kwargs = {}
+        if element_id or _id:
+            kwargs['id'] = element_id or _id
+        if element_class or _class:
+            kwargs['class_'] = element_class or _class
+        return tag, kwargs
+
+    def _build_selectors(self, decoder: dict):
         selector = decoder.get('selector')
+        element = decoder.get('element')
         if selector is None:
             selector = ''
-            element = decoder.get('element')
             _id = decoder.get('id')
             _class = decoder.get('class')
             attributes = decoder.get('attributes')
@@ -86,32 +219,22 @@ class Decoder:
                 selectors = selector.split(XOR_SEPARATOR)
             else:
                 selectors = [selector]
-
-        for selector in selectors:
-            elements = soup.select(selector)
-            if elements:
-                break
-
-        extract = decoder.get('extract')
-        if extract:
-            if extract["type"] == "attr":
-                attr_key = extract["key"]
-                elements_aux = elements
-                elements = []
-                for element in elements_aux:
-                    try:
-                        attr = element[attr_key]
-                        if attr:
-                            elements.append(attr)
-                    except KeyError:
-                        pass
-            if extract["type"] == "text":
-                elements = [element.string for element in elements]
-        return elements if decoder['array'] else elements[0] if elements else None
-
-    def _get_element_by_key(self, json_data, key, value):
-        for item in json_data:
-            if item[key] == value:
-                return item
-        logger.warning('Host not found, using default decoder.')
-        return json_data[0]
+        return [selector for selector in selectors if selector.strip()]
+
+    def _get_decode_guide(self, host: str) -> dict:
+        decode_guide_by_host = load_decode_guide()
+        decode_guide = decode_guide_by_host.get(host)
+        if decode_guide is None:
+            # A host on a non-default port uses the decode guide of its host name
+            decode_guide = decode_guide_by_host.get(host.split(':')[0])
+        if decode_guide is None:
+            logger.warning('Host not found, using default decoder.')
+            # The first decode guide is the default one
+            return next(iter(decode_guide_by_host.values()))
+        return decode_guide
+
+
+@lru_cache(maxsize=None)
+def get_decoder(host: str) -> Decoder:
+    # Decoders are built once per host, with their finders, and shared by the novels of that host
+    return Decoder(host)
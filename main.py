@@ -1,12 +1,18 @@
 import os
+import re
 import json
+from functools import lru_cache
 from pathlib import Path
 
+from typing import TYPE_CHECKING
+
 import click
 
-import custom_logger
-from output_file import OutputFiles
-from novel_scrapper import *
+# The scrapper modules are imported by the commands that use them, so
+# commands like version or --help start without loading them
+if TYPE_CHECKING:
+    from novel_scrapper import Novel
+    from output_file import OutputFiles
 
 CURRENT_DIR = Path(__file__).resolve().parent
 CONTEXT_SETTINGS = dict(default_map={
@@ -14,80 +20,223 @@ CONTEXT_SETTINGS = dict(default_map={
     "FLARESOLVER_URL": "http://localhost:8191/v1"
 })
 
+# YYYY, YYYY-MM or YYYY-MM-DD
+DATE_RE = re.compile(r'^(\d{4})(?:-(\d{2})(?:-(\d{2}))?)?$')
 
-@click.group()
-def cli():
-    """CLI Tool for web novel scraping"""
+
+@lru_cache(maxsize=8)
+def read_config(path: str, mtime_ns: int) -> dict:
+    # Parsed again only when the file changes
+    import orjson
+    return orjson.loads(Path(path).read_bytes())
 
 
 def load_config(ctx, param, value):
-    if value and os.path.exists(value):
-        with open(value, 'r') as f:
-            config = json.load(f)
-        ctx.default_map = ctx.default_map or {}
-        ctx.default_map.update(config)
+    if value:
+        config = read_config(value, os.stat(value).st_mtime_ns)
+        if ctx.default_map is None:
+            ctx.default_map = dict(config)
+        else:
+            ctx.default_map |= config
+    return value
+
+
+@click.group(context_settings={'help_option_names': ['-h', '--help']})
+@click.option('--config', type=click.Path(exists=True, dir_okay=False, readable=True), callback=load_config, is_eager=True, expose_value=False, help='JSON file with the default values of the commands')
+@click.pass_context
+def cli(ctx):
+    """CLI Tool for web novel scraping"""
+    ctx.ensure_object(dict)
+
+
+def validate_date(ctx, param, value):
+    if value is None:
+        return value
+    match = DATE_RE.match(value)
+    if not match or not 1 <= int(match[2] or 1) <= 12 or not 1 <= int(match[3] or 1) <= 31:
+        raise click.BadParameter('Date should be YYYY, YYYY-MM or YYYY-MM-DD')
     return value
 
 
-def load_novel(novel_title: str) -> Novel:
-    output_file = OutputFiles(novel_title)
-    novel_json = output_file.load_novel_json()
+def apply_options(options):
+    def decorator(f):
+        for option in reversed(options):
+            f = option(f)
+        return f
+    return decorator
+
+
+title_option = click.option('-t', '--title', type=str, required=True, help='Novel title')
+
+METADATA_OPTIONS = (
+    click.option('--author', type=str, help='Novel author'),
+    click.option('--start-year', type=str, callback=validate_date, help='Novel start year'),
+    click.option('--end-year', type=str, callback=validate_date, help='Novel end year'),
+    click.option('--language', type=str, help='Novel language'),
+    click.option('--description', type=str, help='Novel description'),
+)
+
+UPDATE_OPTIONS = (
+    click.option('--update-chapters', type=bool, default=False, required=False, help='Update the existing chapters info by checking the html'),
+    click.option('--update-html', type=bool, default=False, required=False, help='Update the existing chapters html by doing a new request'),
+)
+
+
+def get_output_files(ctx: click.Context, novel_title: str) -> 'OutputFiles':
+    # Shared by the commands of the context, the novel dirs are created once
+    output_files = ctx.obj.setdefault('output_files', {})
+    if novel_title not in output_files:
+        from output_file import OutputFiles
+        output_files[novel_title] = OutputFiles(novel_title)
+    return output_files[novel_title]
+
+
+def load_novel(ctx: click.Context, novel_title: str) -> 'Novel':
+    # Novels are loaded once per title and shared by the commands of the context
+    novels = ctx.obj.setdefault('novels', {})
+    if novel_title not in novels:
+        novels[novel_title] = _load_novel(get_output_files(ctx, novel_title))
+    return novels[novel_title]
+
+
+def _load_novel(output_files: 'OutputFiles') -> 'Novel':
+    from novel_scrapper import Novel
+
+    novel_json = output_files.load_novel_json()
     if novel_json:
-        novel = Novel.from_json(novel_json)
+        novel = Novel.from_dict(novel_json)
+        novel.output_files = output_files
         return novel
 
 
 @cli.command()
-@click.option('-t', '--title', type=str, required=True, help='Novel title')
+@title_option
 @click.option('--novel-link', type=str, required=True, help='Main link of the TOC')
-@click.option('--author', type=str, help='Novel author')
-@click.option('--start-year', type=str, help='Novel start year')
-@click.option('--end-year', type=str, help='Novel end year')
-@click.option('--language', type=str, help='Novel language')
-@click.option('--description', type=str, help='Novel description')
-@click.option('-t', '--tag', 'tags', type=str, help='Novel tag', multiple=True)
-@click.option('--cover', type=str, help='Novel cover path')
+@apply_options(METADATA_OPTIONS)
+@click.option('-T', '--tag', 'tags', type=str, help='Novel tag', multiple=True)
+@click.option('--cover', type=click.Path(exists=True, dir_okay=False, readable=True), help='Novel cover path')
 @click.option('--save-title-to-content', type=bool, help='Set if the title of the chapter should be added to the content')
-def create_novel(title, novel_link, author, start_year, end_year, language, description, tags, cover, save_title_to_content):
+@click.pass_context
+def create_novel(ctx, title, novel_link, author, start_year, end_year, language, description, tags, cover, save_title_to_content):
     """Create a new novel"""
-    novel = load_novel(title)
+    novel = load_novel(ctx, title)
     if novel:
         click.confirm(f'A novel with the title {
                       title} already exists, do you want to replace it?', abort=True)
+    from novel_scrapper import Novel
     novel = Novel(title, toc_main_link=novel_link)
-    novel.set_metadata(author=author,
-                       start_year=start_year,
-                       end_year=end_year,
-                       language=language,
-                       description=description)
-    if tags:
-        for tag in tags:
-            novel.add_tag(tag)
-    if cover:
-        novel.set_cover_image(cover)
-    if save_title_to_content is not None:
-        novel.set_save_title_to_content(save_title_to_content)
-
-
-@cli.command()
-@click.option('-t', '--title', type=str, required=True, help='Novel title')
-@click.option('--update-chapters', type=bool, default=False, required=False, help='Update the existing chapters info by checking the html')
-@click.option('--update-html', type=bool, default=False, required=False, help='Update the existing chapters html by doing a new request')
-def scrap_novel(title, update_chapters, update_html):
-    novel = load_novel(title)
+    novel.output_files = get_output_files(ctx, title)
+    ctx.obj['novels'][title] = novel
+    with novel.batch():
+        novel.set_metadata(author=author,
+                           start_year=start_year,
+                           end_year=end_year,
+                           language=language,
+                           description=description)
+        if tags:
+            novel.add_tags(tags)
+        if cover:
+            novel.set_cover_image(cover)
+        if save_title_to_content is not None:
+            novel.set_save_title_to_content(save_title_to_content)
+
+
+@cli.command()
+@title_option
+@apply_options(UPDATE_OPTIONS)
+@click.pass_context
+def scrap_novel(ctx, title, update_chapters, update_html):
+    novel = load_novel(ctx, title)
     if not novel:
         click.echo(message='Novel with that title not exists', err=True)
         return
-    if not novel.toc_links_list:
-        novel.get_links_from_toc()
-    novel.save_novel_to_epub()
+    with novel.batch():
+        if not novel.toc_links_list:
+            novel.get_links_from_toc()
+        novel.save_novel_to_epub()
 
 
 @cli.command()
-@click.option('-t', '--title', type=str, required=True, help='Novel title')
+@title_option
+@click.option('--start-chapter', type=click.IntRange(min=1), default=1, help='First chapter to save')
+@click.option('--end-chapter', type=click.IntRange(min=1), help='Last chapter to save, the last chapter of the novel by default')
+@click.option('--chapters-by-book', type=click.IntRange(min=1), default=100, help='Chapters on each epub file')
+@click.option('--jobs', type=click.IntRange(min=1), default=1, help='Number of epub files built at the same time')
+@click.pass_context
+def save_novel_to_epub(ctx, title, start_chapter, end_chapter, chapters_by_book, jobs):
+    """Save the chapters of the novel to epub files"""
+    if end_chapter is not None and end_chapter < start_chapter:
+        raise click.BadParameter('Should be greater or equal than --start-chapter',
+                                 param_hint='--end-chapter')
+    novel = load_novel(ctx, title)
+    if not novel:
+        click.echo(message='Novel with that title not exists', err=True)
+        return
+    novel.save_novel_to_epub(chaps_by_vol=chapters_by_book,
+                             start_chapter=start_chapter,
+                             end_chapter=end_chapter,
+                             jobs=jobs)
+
+
+@cli.command()
+@title_option
+@apply_options(UPDATE_OPTIONS)
+@click.option('--concurrency', type=click.IntRange(min=1), default=8, help='Number of chapters requested at the same time')
+@click.option('--per-host-delay', type=click.FloatRange(min=0), default=0, help='Seconds to wait before each request')
+@click.pass_context
+def request_all_chapters(ctx, title, update_chapters, update_html, concurrency, per_host_delay):
+    """Request and save the html of all the chapters of the TOC"""
+    novel = load_novel(ctx, title)
+    if not novel:
+        click.echo(message='Novel with that title not exists', err=True)
+        return
+    with novel.batch():
+        novel.scrap_all_chapters(update_chapters=update_chapters,
+                                 update_html=update_html,
+                                 concurrency=concurrency,
+                                 delay=per_host_delay)
+
+
+@cli.command()
+@title_option
+@click.option('--chapter-url', type=str, help='Link of the chapter')
+@click.option('--chapter-num', type=click.IntRange(min=1), help='Number of the chapter on the novel')
+@click.option('--update-html', type=bool, default=False, required=False, help='Update the chapter html by doing a new request')
+@click.pass_context
+def scrap_chapter(ctx, title, chapter_url, chapter_num, update_html):
+    """Scrap a chapter and show its content"""
+    if (chapter_url is None) == (chapter_num is None):
+        raise click.UsageError('Use one of --chapter-url or --chapter-num')
+    novel = load_novel(ctx, title)
+    if not novel:
+        click.echo(message='Novel with that title not exists', err=True)
+        return
+    # The chapters are only counted when a chapter number is given
+    if chapter_num is not None:
+        if chapter_num > len(novel.chapters):
+            raise click.BadParameter(f'The novel has {len(novel.chapters)} chapters',
+                                     param_hint='--chapter-num')
+        chapter = novel.chapters[chapter_num - 1]
+        chapter_url, chapter_html_filename = chapter.chapter_link, chapter.chapter_html_filename
+    else:
+        chapter_html_filename = None
+    with novel.batch():
+        scrapped_chapter = novel.scrap_chapter(chapter_url,
+                                               file_path=chapter_html_filename,
+                                               update_html=update_html)
+    if not scrapped_chapter:
+        click.echo(message='Chapter could not be scrapped', err=True)
+        return
+    _, chapter_title, chapter_content = scrapped_chapter
+    click.echo(f'{chapter_title}\n{chapter_content}')
+
+
+@cli.command()
+@title_option
 @click.option('--save-title-to-content', type=bool, required=True, help='Set if the title of the chapter should be added to the content')
-def set_save_title_to_content(title, save_title_to_content):
-    novel = load_novel(title)
+@click.pass_context
+def set_save_title_to_content(ctx, title, save_title_to_content):
+    novel = load_novel(ctx, title)
     if not novel:
         click.echo(message='Novel with that title not exists', err=True)
         return
@@ -95,10 +244,11 @@ def set_save_title_to_content(title, save_title_to_content):
 
 
 @cli.command()
-@click.option('-t', '--title', type=str, required=True, help='Novel title')
+@title_option
 @click.option('--toc-link', type=str, required=True, help='New TOC link')
-def set_toc(title, toc_link):
-    novel = load_novel(title)
+@click.pass_context
+def set_toc(ctx, title, toc_link):
+    novel = load_novel(ctx, title)
     if not novel:
         click.echo(message='Novel with that title not exists', err=True)
         return
@@ -106,10 +256,11 @@ def set_toc(title, toc_link):
 
 
 @cli.command()
-@click.option('-t', '--title', type=str, required=True, help='Novel title')
+@title_option
 @click.option('--tag', type=str, required=True, help='New Tag')
-def add_tag(title, tag):
-    novel = load_novel(title)
+@click.pass_context
+def add_tag(ctx, title, tag):
+    novel = load_novel(ctx, title)
     if not novel:
         click.echo(message='Novel with that title not exists', err=True)
         return
@@ -117,10 +268,11 @@ def add_tag(title, tag):
 
 
 @cli.command()
-@click.option('-t', '--title', type=str, required=True, help='Novel title')
+@title_option
 @click.option('--tag', type=str, required=True, help='New Tag')
-def remove_tag(title, tag):
-    novel = load_novel(title)
+@click.pass_context
+def remove_tag(ctx, title, tag):
+    novel = load_novel(ctx, title)
     if not novel:
         click.echo(message='Novel with that title not exists', err=True)
         return
@@ -128,10 +280,11 @@ def remove_tag(title, tag):
 
 
 @cli.command()
-@click.option('-t', '--title', type=str, required=True, help='Novel title')
-@click.option('--cover-image-file', type=str, required=True, help='Filepath of the cover image')
-def set_cover_image(title, cover_image_file):
-    novel = load_novel(title)
+@title_option
+@click.option('--cover-image-file', type=click.Path(exists=True, dir_okay=False, readable=True), required=True, help='Filepath of the cover image')
+@click.pass_context
+def set_cover_image(ctx, title, cover_image_file):
+    novel = load_novel(ctx, title)
     if not novel:
         click.echo(message='Novel with that title not exists', err=True)
         return
@@ -139,10 +292,11 @@ def set_cover_image(title, cover_image_file):
 
 
 @cli.command()
-@click.option('-t', '--title', type=str, required=True, help='Novel title')
+@title_option
 @click.option('--toc-link', type=str, required=False, help='New TOC link')
-def update_toc(title, toc_link):
-    novel = load_novel(title)
+@click.pass_context
+def update_toc(ctx, title, toc_link):
+    novel = load_novel(ctx, title)
     if not novel:
         click.echo(message='Novel with that title not exists', err=True)
         return
@@ -152,36 +306,63 @@ def update_toc(title, toc_link):
         novel.update_toc_links_list()
 
 @cli.command()
-@click.option('-t', '--title', type=str, required=True, help='Novel title')
-@click.option('--toc-html', type=click.File(errors="ignore"), required=True, help='Novel TOC custom HTML')
-def add_toc(title, toc_html):
-    novel = load_novel(title)
+@title_option
+@click.option('--toc-html', type=click.File('rb'), required=True, help='Novel TOC custom HTML')
+@click.pass_context
+def add_toc(ctx, title, toc_html):
+    novel = load_novel(ctx, title)
     if not novel:
         click.echo(message='Novel with that title not exists', err=True)
         return
-    html_content = toc_html.read()
-    novel.add_custom_toc(html_content)
+    novel.add_custom_toc_file(toc_html)
+
+@cli.command()
+@title_option
+@click.option('--toc-html', type=click.File('rb'), required=True, help='Novel TOC custom HTML')
+@click.pass_context
+def set_custom_toc_html(ctx, title, toc_html: click.File):
+    novel = load_novel(ctx, title)
+    if not novel:
+        click.echo(message='Novel with that title not exists', err=True)
+        return
+    novel.set_custom_toc_file(toc_html)
+
+
+@cli.command()
+@title_option
+@click.option('--workers', type=click.IntRange(min=1), help='Number of threads cleaning the files, the number of CPUs by default')
+@click.pass_context
+def clean_files(ctx, title, workers):
+    novel = load_novel(ctx, title)
+    if not novel:
+        click.echo(message='Novel with that title not exists', err=True)
+        return
+    novel.clean_chapters_html_files(workers=workers)
+
 
 @cli.command()
-@click.option('-t', '--title', type=str, required=True, help='Novel title')
-@click.option('--toc-html', type=click.File(errors="replace"), required=True, help='Novel TOC custom HTML')
-def set_custom_toc_html(title, toc_html: click.File):
-    novel = load_novel(title)
+@title_option
+@click.pass_context
+def show_chapters(ctx, title):
+    """Show the chapters of the novel"""
+    novel = load_novel(ctx, title)
     if not novel:
         click.echo(message='Novel with that title not exists', err=True)
         return
-    html_content = toc_html.read()
-    novel.set_custom_toc(html_content)
+    # A single write for all the lines
+    click.echo(novel.show_chapters(), nl=False)
 
 
 @cli.command()
-@click.option('-t', '--title', type=str, required=True, help='Novel title')
-def clean_files(title):
-    novel = load_novel(title)
+@title_option
+@click.pass_context
+def show_toc(ctx, title):
+    """Show the chapter links found on the TOC"""
+    novel = load_novel(ctx, title)
     if not novel:
         click.echo(message='Novel with that title not exists', err=True)
         return
-    novel.clean_chapters_html_files()
+    click.echo(novel.show_toc(), nl=False)
 
 
 @cli.command()
@@ -1,21 +1,32 @@
 import os
+import io
+import re
+from contextlib import contextmanager
 from pathlib import Path
-from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
 import json
 
 from dataclasses_json import dataclass_json
-from ebooklib import epub
-from typing import Optional
+from typing import Optional, BinaryIO, Iterable, TYPE_CHECKING
 
 import custom_logger
-from decode import Decoder
+from decode import Decoder, get_decoder
 import custom_request
 from output_file import OutputFiles
 import utils
 
+# ebooklib is only needed to build the epub files
+if TYPE_CHECKING:
+    from ebooklib import epub
+
 CURRENT_DIR = Path(__file__).resolve().parent
 logger = custom_logger.create_logger('NOVEL SCRAPPING')
 
+# Toc pages numbered on the link, like ?page=2 or /page/2
+TOC_PAGE_NUMBER_RE = re.compile(r'(page[=/-])(\d+)', re.IGNORECASE)
+TOC_PREFETCH_PAGES = 8
+
 
 @dataclass_json
 @dataclass
@@ -29,6 +40,10 @@ class Metadata:
     cover_image_path: Optional[str] = None
     tags: list[str] = field(default_factory=list)
 
+    def __post_init__(self):
+        # Not a field, mirrors the tags for the membership checks
+        self._tag_set = set(self.tags)
+
 
 @dataclass_json
 @dataclass
@@ -44,6 +59,11 @@ class Chapter:
         return self.chapter_title < another.chapter_title
 
 
+# Field names read once, to build the json of the novel without dataclasses_json
+METADATA_FIELDS = tuple(metadata_field.name for metadata_field in fields(Metadata))
+CHAPTER_FIELDS = tuple(chapter_field.name for chapter_field in fields(Chapter))
+
+
 @dataclass_json
 @dataclass
 class Novel:
@@ -70,14 +90,37 @@ class Novel:
             raise ValueError("You need to set 'novel_title' or 'metadata'.")
 
         self.chapters = chapters if chapters else []
+        # Position of each chapter link on self.chapters, built when first needed
+        self._chapter_index = None
+        self._chapter_index_size = 0
         self.toc_main_link = toc_main_link
         self.toc_links_list = toc_links_list if toc_links_list else []
 
         self.toc = [{}]
-        self.output_files = OutputFiles(self.metadata.novel_title)
-        self.save_novel_to_json()
-        self.decoder = Decoder(utils.obtain_host(self.toc_main_link))
+        # Created when first needed, the output files can also be set by the caller to share them
+        self._output_files = None
+        # Created when first needed, commands that don't decode html never build it
+        self._decoder = None
         self.save_title_to_content = save_title_to_content
+        # Inside batch() the saves are deferred until the batch ends
+        self._autosave = True
+        self._unsaved_changes = False
+
+    @property
+    def output_files(self) -> OutputFiles:
+        if self._output_files is None:
+            self._output_files = OutputFiles(self.metadata.novel_title)
+        return self._output_files
+
+    @output_files.setter
+    def output_files(self, output_files: OutputFiles):
+        self._output_files = output_files
+
+    @property
+    def decoder(self) -> Decoder:
+        if self._decoder is None:
+            self._decoder = get_decoder(utils.obtain_host(self.toc_main_link))
+        return self._decoder
 
     def set_save_title_to_content(self, save_title_to_content: bool):
         self.save_title_to_content = save_title_to_content
@@ -96,15 +139,27 @@ class Novel:
         self.save_novel_to_json()
 
     def add_tag(self, tag: str) -> None:
-        if tag not in self.metadata.tags:
+        self.add_tags([tag])
+
+    def add_tags(self, tags: list[str]) -> int:
+        existing_tags = self.metadata._tag_set
+        added_tags = 0
+        for tag in tags:
+            if tag in existing_tags:
+                logger.warning(f'Tag "{tag}" already exists on novel {
+                               self.metadata.novel_title}')
+                continue
+            existing_tags.add(tag)
             self.metadata.tags.append(tag)
+            added_tags += 1
+        # Saved once for all the tags
+        if added_tags:
             self.save_novel_to_json()
-            return
-        logger.warning(f'Tag "{tag}" already exists on novel {
-                       self.metadata.novel_title}')
+        return added_tags
 
     def remove_tag(self, tag: str) -> None:
-        if tag in self.metadata.tags:
+        if tag in self.metadata._tag_set:
+            self.metadata._tag_set.discard(tag)
             self.metadata.tags.remove(tag)
             self.save_novel_to_json()
             return
@@ -121,54 +176,127 @@ class Novel:
                         self.metadata.cover_image_path}')
 
     def save_novel_to_json(self) -> None:
-        self.output_files.save_novel_json(self.to_dict())
+        if not self._autosave:
+            self._unsaved_changes = True
+            return
+        self.output_files.save_novel_json(self._to_json_dict())
+        self._unsaved_changes = False
+
+    def _to_json_dict(self) -> dict:
+        # Same dict as to_dict, which inspects the type of every field of every chapter on each save
+        metadata = self.metadata
+        return {
+            'metadata': {name: getattr(metadata, name) for name in METADATA_FIELDS},
+            'chapters': [{name: getattr(chapter, name) for name in CHAPTER_FIELDS}
+                         for chapter in self.chapters],
+            'toc_main_link': self.toc_main_link,
+            'toc_links_list': self.toc_links_list,
+            'save_title_to_content': self.save_title_to_content,
+        }
+
+    @contextmanager
+    def batch(self):
+        # Several changes to the novel are written to the json only once
+        previous_autosave = self._autosave
+        self._autosave = False
+        try:
+            yield self
+        finally:
+            self._autosave = previous_autosave
+            if self._autosave and self._unsaved_changes:
+                self.save_novel_to_json()
 
     def set_toc_main_link(self, toc_main_link: str) -> None:
         self.toc_main_link = toc_main_link
         self.output_files.clear_toc()
-        self.decoder = Decoder(utils.obtain_host(self.toc_main_link))
+        self._decoder = None
         self.update_toc_links_list(update_toc=True)
 
     def get_links_from_toc(self) -> None:
+        self._set_toc_links_list(self._get_links_from_tocs(self.output_files.get_all_toc()))
+
+    def _get_links_from_tocs(self, tocs: Iterable[str]) -> list[str]:
         links = []
-        tocs = self.output_files.get_all_toc()
+        # Resolved once for all the toc pages
+        decoder = self.decoder
         for toc_content in tocs:
-            toc_links = self.decoder.decode_html(toc_content, 'index')
-            toc_links = [link['href'] for link in toc_links]
-            if toc_links:
-                links = [*links, *toc_links]
-        links = [f'https://www.{self.decoder.host}{link}' for link in links if self.decoder.host not in link]
-        self.toc_links_list = links
-        self.create_chapters_from_toc()
-        self.save_novel_to_json()
+            toc_links = decoder.decode_html(toc_content, 'index')
+            links.extend(link['href'] for link in toc_links)
+        return links
+
+    def _set_toc_links_list(self, links: list[str]) -> None:
+        host = self.decoder.host
+        links = [f'https://www.{host}{link}' for link in links if host not in link]
+        # The same chapter can be linked from several toc pages
+        self.toc_links_list = utils.remove_duplicates_in_list(links)
+        with self.batch():
+            self.create_chapters_from_toc()
+            self.save_novel_to_json()
 
     def update_toc_links_list(self, update_toc: bool = False) -> None:
-        toc_content, _ = utils.get_url_or_temp_file(self.output_files,
-                                                    self.toc_main_link,
-                                                    reload=update_toc)
+        # None when the request failed
+        toc_page = utils.get_url_or_temp_file(self.output_files,
+                                              self.toc_main_link,
+                                              reload=update_toc)
 
-        if not toc_content:
+        if not toc_page:
             logger.warning(f'No content found on link {self.toc_main_link}')
             return
+        # The toc pages saved before are read from their files, the new ones
+        # are decoded while paginating so each page is parsed once
+        links = self._get_links_from_tocs(self.output_files.get_all_toc())
+        toc_content, _ = toc_page
         self.output_files.add_toc(toc_content)
 
-        if self.decoder.has_pagination():
-            next_link_tag = self.decoder.decode_html(toc_content, 'next_page')
-            aux = 1
+        content_types = ['index', 'next_page'] if self.decoder.has_pagination() else ['index']
+        decoded_toc = self.decoder.decode_all(toc_content, content_types)
+        links.extend(link['href'] for link in decoded_toc['index'])
+
+        if 'next_page' in decoded_toc:
+            next_link_tag = decoded_toc['next_page']
+            visited_links = {self.toc_main_link}
+            prefetched_links = set()
 
             while next_link_tag:
                 next_link = next_link_tag[0]['href']
-
-                toc_new_content, _ = utils.get_url_or_temp_file(self.output_files,
-                                                                next_link,
-                                                                reload=update_toc)
-                if toc_new_content:
-                    next_link_tag = self.decoder.decode_html(
-                        toc_new_content, 'next_page')
-                    self.output_files.add_toc(toc_new_content)
-                aux += 1
-        self.get_links_from_toc()
-
+                # A last page that links to itself would never end the pagination
+                if next_link in visited_links:
+                    break
+                visited_links.add(next_link)
+                if next_link not in prefetched_links:
+                    prefetched_links.update(self._prefetch_toc_pages(next_link, update_toc))
+
+                toc_page = utils.get_url_or_temp_file(self.output_files,
+                                                      next_link,
+                                                      reload=update_toc and next_link not in prefetched_links)
+                if not toc_page:
+                    logger.warning(f'No content found on link {next_link}, stopping the pagination')
+                    break
+                toc_new_content, _ = toc_page
+                decoded_toc = self.decoder.decode_all(toc_new_content, content_types)
+                links.extend(link['href'] for link in decoded_toc['index'])
+                next_link_tag = decoded_toc['next_page']
+                self.output_files.add_toc(toc_new_content)
+            # Prefetched pages past the last one are not part of the toc
+            for page_link in prefetched_links - visited_links:
+                self.output_files.clean_temp_file(utils.generate_file_name_from_url(page_link))
+        self._set_toc_links_list(links)
+
+    def _prefetch_toc_pages(self, next_link: str, reload: bool) -> list[str]:
+        # The following numbered pages are requested concurrently, the pagination then reads them from the temp files.
+        # Pages past the last one are expected to fail, so they don't fall back to FlareSolver
+        match = TOC_PAGE_NUMBER_RE.search(next_link)
+        if not match:
+            return []
+        page_num = int(match.group(2))
+        page_links = [f'{next_link[:match.start(2)]}{page_num + offset}{next_link[match.end(2):]}'
+                      for offset in range(TOC_PREFETCH_PAGES)]
+        utils.fetch_urls_to_temp_files(self.output_files,
+                                       page_links,
+                                       reload=reload,
+                                       max_workers=TOC_PREFETCH_PAGES,
+                                       flaresolver=False)
+        return page_links
 
     def add_or_update_chapter(self, chapter: Chapter, link_idx: int = None) -> None:
         if link_idx:
@@ -179,39 +307,47 @@ class Novel:
             if chapter_idx is None:
                 # If no existing chapter we append it
                 self.chapters.append(chapter)
-                chapter_idx = len(self.chapters)
+                chapter_idx = len(self.chapters) - 1
+                self._chapter_index[chapter.chapter_link] = chapter_idx
+                self._chapter_index_size = len(self.chapters)
             else:
                 self.chapters[chapter_idx] = chapter
         self.save_novel_to_json()
         return chapter_idx
 
     def order_chapters_by_link_list(self) -> None:
-        self.chapters.sort(
-            key=lambda x: self.toc_links_list.index(x.chapter_link))
+        # Position of each link built once, chapters not on the toc go last keeping their order
+        link_order = {link: idx for idx, link in enumerate(self.toc_links_list)}
+        not_on_toc = len(link_order)
+        self.chapters.sort(key=lambda x: link_order.get(x.chapter_link, not_on_toc))
+        self._chapter_index = None
 
     def scrap_chapter(self, chapter_link: str, file_path: str = None, update_html: bool = False) -> Chapter:
-        chapter_html, chapter_html_filename = utils.get_url_or_temp_file(self.output_files,
-                                                                         chapter_link,
-                                                                         file_path,
-                                                                         update_html)
+        chapter_page = utils.get_url_or_temp_file(self.output_files,
+                                                  chapter_link,
+                                                  file_path,
+                                                  update_html)
         # We create a new chapter using the link and add it to the list of Chapters
-        if not chapter_html or not chapter_html_filename:
+        if not chapter_page:
             logger.warning(f'Failed to create chapter on link: "{
-                           chapter_link}" on path "{chapter_html_filename}"')
+                           chapter_link}" on path "{file_path}"')
             return
+        chapter_html, chapter_html_filename = chapter_page
 
         chapter = Chapter(chapter_link=chapter_link,
                           chapter_html_filename=chapter_html_filename)
-        self.add_or_update_chapter(chapter=chapter)
-
-        # We get the title and content, if there's no title, we autogenerate one.
-        chapter_title, chapter_content = self.get_chapter_content(
-            chapter=chapter, chapter_html=chapter_html)
-
-        chapter = Chapter(chapter_title=chapter_title,
-                          chapter_link=chapter_link,
-                          chapter_html_filename=chapter_html_filename)
-        self.add_or_update_chapter(chapter)
+        # The chapter is added before decoding since the autogenerated title uses its position,
+        # the novel is saved once with the title
+        with self.batch():
+            self.add_or_update_chapter(chapter=chapter)
+
+            # We get the title and content, if there's no title, we autogenerate one.
+            chapter_title_and_content = self.get_chapter_content(
+                chapter=chapter, chapter_html=chapter_html)
+            if not chapter_title_and_content:
+                return
+            chapter_title, chapter_content = chapter_title_and_content
+            chapter.chapter_title = chapter_title
         logger.info(f'Chapter scrapped from link: {chapter_link}')
         return chapter, chapter_title, chapter_content
 
@@ -220,35 +356,87 @@ class Novel:
         self.output_files.add_toc(html)
         self.get_links_from_toc()
 
+    def set_custom_toc_file(self, toc_file: BinaryIO):
+        self.clear_toc()
+        self.output_files.add_toc_from_file(toc_file)
+        self.get_links_from_toc()
+
     def create_chapters_from_toc(self):
-        for chapter_link in self.toc_links_list:
-            chapter_idx = self.find_chapter_index_by_link(chapter_link)
-            if not chapter_idx:
-                chapter = Chapter(chapter_link=chapter_link)
-                self.add_or_update_chapter(chapter=chapter)
-        self.order_chapters_by_link_list()
-
-    def scrap_all_chapters(self, update_chapters: bool = False, update_html: bool = False) -> None:
+        with self.batch():
+            for chapter_link in self.toc_links_list:
+                chapter_idx = self.find_chapter_index_by_link(chapter_link)
+                if chapter_idx is None:
+                    chapter = Chapter(chapter_link=chapter_link)
+                    self.add_or_update_chapter(chapter=chapter)
+            self.order_chapters_by_link_list()
+
+    def scrap_all_chapters(self,
+                           update_chapters: bool = False,
+                           update_html: bool = False,
+                           concurrency: int = 8,
+                           delay: float = 0) -> None:
         if self.toc_links_list:
+            chapter_links = []
+            temp_file_names = self.output_files.get_temp_file_names()
             for chapter_link in self.toc_links_list:
                 # Search if the chapter exists
                 chapter_idx = self.find_chapter_index_by_link(chapter_link)
-                if not chapter_idx:
-                    self.scrap_chapter(chapter_link,
-                                       update_html=update_html)
-                elif chapter_idx is not None and update_chapters:
-                    self.scrap_chapter(chapter_link,
-                                       update_html=update_html)
+                if update_chapters or chapter_idx is None:
+                    chapter_links.append(chapter_link)
+                    continue
+                # Chapters created from the toc have no html until they are scrapped
+                chapter_html_filename = self.chapters[chapter_idx].chapter_html_filename
+                if chapter_html_filename is None or chapter_html_filename not in temp_file_names:
+                    chapter_links.append(chapter_link)
+
+            # Download all the html concurrently, scrap_chapter will use the temp files
+            utils.fetch_urls_to_temp_files(self.output_files,
+                                           chapter_links,
+                                           reload=update_html,
+                                           max_workers=concurrency,
+                                           delay=delay)
+            # Saved once after all the chapters
+            with self.batch():
+                for chapter_link in chapter_links:
+                    self.scrap_chapter(chapter_link)
         else:
             logger.warning('No links found on toc_links_list')
 
-    def find_chapter_index_by_link(self, chapter_link: str) -> str:
-        for index, chapter in enumerate(self.chapters):
-            if chapter.chapter_link == chapter_link:
-                return index
-        return None
-
-    def create_epub_book(self, book_title: str = None, calibre_collection: dict = None) -> epub.EpubBook:
+    def show_chapters(self) -> str:
+        buffer = io.StringIO()
+        write = buffer.write
+        for idx, chapter in enumerate(self.chapters, start=1):
+            write(f'{idx}. {chapter}\n')
+        return buffer.getvalue()
+
+    def show_toc(self) -> str:
+        buffer = io.StringIO()
+        write = buffer.write
+        for idx, link in enumerate(self.toc_links_list, start=1):
+            write(f'{idx}. {link}\n')
+        return buffer.getvalue()
+
+    def find_chapter_index_by_link(self, chapter_link: str) -> int:
+        chapter_index = self._get_chapter_index()
+        index = chapter_index.get(chapter_link)
+        if index is not None and self.chapters[index].chapter_link != chapter_link:
+            # The chapters were changed without updating the index
+            self._chapter_index = None
+            index = self._get_chapter_index().get(chapter_link)
+        return index
+
+    def _get_chapter_index(self) -> dict[str, int]:
+        if self._chapter_index is None or self._chapter_index_size != len(self.chapters):
+            chapter_index = {}
+            for index, chapter in enumerate(self.chapters):
+                # The first chapter with the link is kept, like the linear search did
+                chapter_index.setdefault(chapter.chapter_link, index)
+            self._chapter_index = chapter_index
+            self._chapter_index_size = len(self.chapters)
+        return self._chapter_index
+
+    def create_epub_book(self, book_title: str = None, calibre_collection: dict = None) -> 'epub.EpubBook':
+        from ebooklib import epub
         book = epub.EpubBook()
         if not book_title:
             book_title = self.metadata.novel_title
@@ -299,29 +487,43 @@ class Novel:
                 chapter_html, _ = utils.get_url_or_temp_file(self.output_files,
                                                              chapter.chapter_link,
                                                              chapter.chapter_html_filename)
-            paragraphs = self.decoder.decode_html(chapter_html, 'content')
+            decoded_title, paragraphs = self._decode_chapter(chapter, chapter_html)
             title = chapter.chapter_title
             if title is None:
-                title = self.decoder.decode_html(chapter_html, 'title')
+                title = decoded_title
             if title is None:
                 title = f'{self.metadata.novel_title} Chapter {
                     self.find_chapter_index_by_link(chapter.chapter_link) + 1}'
             title = str(title)
 
-            chapter_content = ""
-            if self.save_title_to_content:
-                chapter_content += f'<h4>{title}</h4>'
             if paragraphs:
                 logger.info(f'{len(paragraphs)} paragraphs found in chapter link {
                             chapter.chapter_link}')
-                for paragraph in paragraphs:
-                    chapter_content += str(paragraph)
-                return title, chapter_content
+                # Joined once instead of growing the content on each paragraph
+                chapter_content = [f'<h4>{title}</h4>'] if self.save_title_to_content else []
+                chapter_content.extend(paragraphs)
+                return title, ''.join(chapter_content)
             logger.warning(f'No chapter content found for chapter link {
                            chapter.chapter_link} on file {chapter.chapter_html_filename}')
 
         logger.warning('No chapter given')
 
+    def _decode_chapter(self, chapter: Chapter, chapter_html: str) -> tuple[Optional[str], Optional[list[str]]]:
+        # Rebuilding an epub reuses the chapters decoded before instead of parsing their html again
+        filename = chapter.chapter_html_filename
+        if filename:
+            decoded_chapter = self.output_files.load_decoded_chapter(filename, self.decoder.cache_key)
+            if decoded_chapter is not None:
+                return decoded_chapter
+        decoded = self.decoder.decode_all(chapter_html, ['content', 'title'])
+        title = decoded['title']
+        paragraphs = decoded['content']
+        decoded_chapter = (str(title) if title is not None else None,
+                           [str(paragraph) for paragraph in paragraphs] if paragraphs else None)
+        if filename:
+            self.output_files.save_decoded_chapter(filename, self.decoder.cache_key, decoded_chapter)
+        return decoded_chapter
+
     def save_chapters_to_epub(self,
                               chapters_start: int,
                               chapters_num: int = 100,
@@ -334,9 +536,10 @@ class Novel:
 
         if not chapters_end:
             chapters_end = chapters_start + chapters_num - 1
-            if chapters_end > len(self.chapters):
-                chapters_end = len(self.chapters)
-        idx_end = chapters_end + 1
+        if chapters_end > len(self.chapters):
+            chapters_end = len(self.chapters)
+        # chapters_end is the number of the last chapter, which is the index after it
+        idx_end = chapters_end
 
         book_title = f'{self.metadata.novel_title} Chapters {
             chapters_start} - {chapters_end}'
@@ -344,42 +547,74 @@ class Novel:
         if collection_idx:
             calibre_collection = {'title': self.metadata.novel_title,
                                   'idx': str(collection_idx)}
+        from ebooklib import epub
         book = self.create_epub_book(book_title, calibre_collection)
 
-        for chapter in self.chapters[idx_start:idx_end]:
-            _, title, chapter_content = self.scrap_chapter(
-                chapter_link=chapter.chapter_link)
-            if not chapter_content:
-                logger.warning(f'Error reading chapter')
-                continue
-            file_name = utils.generate_epub_file_name_from_title(title)
-
-            chapter_epub = epub.EpubHtml(title=title, file_name=file_name)
-            chapter_epub.set_content(chapter_content)
-            book.add_item(chapter_epub)
-            link = epub.Link(file_name, title, file_name.rstrip('.xhtml'))
-            toc = book.toc
-            toc.append(link)
-            book.toc = toc
-            book.spine.append(chapter_epub)
+        chapters = self.chapters[idx_start:idx_end]
+        # The html of the chapters not saved yet is requested concurrently before building the book
+        utils.fetch_urls_to_temp_files(self.output_files,
+                                       [chapter.chapter_link for chapter in chapters])
+        toc_links = []
+        # The chapter titles are saved once after all the chapters
+        with self.batch():
+            for chapter in chapters:
+                scrapped_chapter = self.scrap_chapter(
+                    chapter_link=chapter.chapter_link)
+                if not scrapped_chapter:
+                    logger.warning(f'Error reading chapter')
+                    continue
+                _, title, chapter_content = scrapped_chapter
+                file_name = utils.generate_epub_file_name_from_title(title)
+
+                chapter_epub = epub.EpubHtml(title=title, file_name=file_name)
+                chapter_epub.set_content(chapter_content)
+                book.add_item(chapter_epub)
+                toc_links.append(epub.Link(file_name, title, file_name.rstrip('.xhtml')))
+                book.spine.append(chapter_epub)
+        book.toc = toc_links
+        # The parsed tree of the last chapter is not needed while the book is written
+        self.decoder.clear_soup_cache()
 
         book.add_item(epub.EpubNcx())
         book.add_item(epub.EpubNav())
-        output_epub_filepath = f'{
-            self.output_files.get_output_dir()}/{book_title}.epub'
-        epub.write_epub(output_epub_filepath, book)
-        logger.info(f'Saved epub to file {output_epub_filepath}')
-
-    def save_novel_to_epub(self, chaps_by_vol: int = 100) -> None:
-        start = 1
-        idx = 1
-        while start < len(self.chapters):
-            self.save_chapters_to_epub(chapters_start=start,
-                                       chapters_num=chaps_by_vol,
-                                       collection_idx=idx)
-            start = start + chaps_by_vol
-            idx = idx + 1
-            
+        output_epub_filepath = self.output_files.save_book(book, f'{book_title}.epub')
+        if output_epub_filepath:
+            logger.info(f'Saved epub to file {output_epub_filepath}')
+
+    def save_novel_to_epub(self,
+                           chaps_by_vol: int = 100,
+                           start_chapter: int = 1,
+                           end_chapter: int = None,
+                           jobs: int = 1) -> None:
+        if end_chapter is None or end_chapter > len(self.chapters):
+            end_chapter = len(self.chapters)
+        # (first chapter, last chapter, collection index) of each book
+        books = [(start, min(start + chaps_by_vol - 1, end_chapter), idx)
+                 for idx, start in enumerate(range(start_chapter, end_chapter + 1, chaps_by_vol), start=1)]
+        if jobs <= 1 or len(books) <= 1:
+            for start, end, idx in books:
+                self.save_chapters_to_epub(chapters_start=start,
+                                           chapters_num=chaps_by_vol,
+                                           chapters_end=end,
+                                           collection_idx=idx)
+            return
+
+        # Building the epub files is CPU bound, each book is built on its own process
+        novel_dict = self._to_json_dict()
+        with ProcessPoolExecutor(max_workers=min(jobs, len(books))) as executor:
+            futures = [executor.submit(_save_chapters_to_epub_in_process, novel_dict, start, end, idx)
+                       for start, end, idx in books]
+            for (start, end, _), future in zip(books, futures):
+                try:
+                    chapters = future.result()
+                except Exception as e:
+                    logger.error(f'Error saving epub of chapters {start} - {end}: {e}')
+                    continue
+                # The chapters updated by the worker are merged back into the novel
+                self.chapters[start - 1:end] = chapters
+        self.save_novel_to_json()
+
+
     def clear_toc(self):
         self.output_files.clear_toc()
 
@@ -387,11 +622,38 @@ class Novel:
         self.output_files.add_toc(html)
         self.get_links_from_toc()
 
-    def clean_chapters_html_files(self):
-        for chapter in self.chapters:
-            if chapter.chapter_html_filename:
-                chapter_html, _ = utils.get_url_or_temp_file(
-                    self.output_files, chapter.chapter_link, chapter.chapter_html_filename)
-                chapter_html = self.decoder.clean_html(chapter_html)
-                self.output_files.save_to_temp_file(
-                    chapter.chapter_html_filename, chapter_html)
+    def add_custom_toc_file(self, toc_file: BinaryIO):
+        self.output_files.add_toc_from_file(toc_file)
+        self.get_links_from_toc()
+
+    def clean_chapters_html_files(self, workers: int = None):
+        chapters = [chapter for chapter in self.chapters if chapter.chapter_html_filename]
+        # lxml releases the GIL while parsing, so the files are cleaned in threads
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            list(executor.map(self._clean_chapter_html_file, chapters))
+
+    def _clean_chapter_html_file(self, chapter: Chapter):
+        # Only the saved html is cleaned, a missing file is not requested again just to be cleaned
+        chapter_html = self.output_files.load_from_temp_file(chapter.chapter_html_filename)
+        if not chapter_html:
+            logger.warning(f'No html found for chapter link {chapter.chapter_link}')
+            return
+        chapter_html = self.decoder.clean_html(chapter_html)
+        if chapter_html is None:
+            logger.warning(f'Html of chapter link {chapter.chapter_link} could not be cleaned, skipping it')
+            return
+        self.output_files.save_to_temp_file(
+            chapter.chapter_html_filename, chapter_html)
+
+
+def _save_chapters_to_epub_in_process(novel_dict: dict,
+                                      chapters_start: int,
+                                      chapters_end: int,
+                                      collection_idx: int) -> list[Chapter]:
+    # Runs on a worker process, only the main process saves the novel json
+    novel = Novel.from_dict(novel_dict)
+    novel._autosave = False
+    novel.save_chapters_to_epub(chapters_start=chapters_start,
+                                chapters_end=chapters_end,
+                                collection_idx=collection_idx)
+    return novel.chapters[chapters_start - 1:chapters_end]
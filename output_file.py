@@ -1,19 +1,56 @@
 import os
-import json
+import re
+import codecs
+import marshal
+import mmap
+from contextlib import contextmanager
 from pathlib import Path
 import shutil
+from typing import BinaryIO, Iterable, TYPE_CHECKING
 import custom_logger
 
+import orjson
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    from ebooklib import epub
+
 load_dotenv()
 
 CURRENT_DIR = Path(__file__).resolve().parent
 
 NOVEL_LOCATION = os.getenv('NOVEL_LOCATION', F'{CURRENT_DIR}')
+# Deflate level of the epub files, the fastest by default since chapters are small xhtml files
+EPUB_COMPRESS_LEVEL = int(os.getenv('EPUB_COMPRESS_LEVEL', '1'))
 
 logger = custom_logger.create_logger('GET OUTPUT OR TEMP FILE')
 
+FILE_ENCODING = 'UTF-8'
+
+# Toc pages are kept in their own dir, apart from the temp files named after urls
+TOC_DIR = 'toc'
+TOC_PREFFIX = 'toc'
+TOC_FILE_RE = re.compile(rf'^{TOC_PREFFIX}_(\d+)\.html$')
+
+
+def decode_file_content(content: bytes) -> str:
+    # Files were saved as UTF-16 by older versions, those start with a BOM
+    if content.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return content.decode('UTF-16')
+    return content.decode(FILE_ENCODING)
+
+
+@contextmanager
+def map_file(file: BinaryIO):
+    # Regular files are mapped, pipes like stdin or empty files are read
+    try:
+        file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        yield file.read()
+        return
+    with file_map:
+        yield file_map
+
 
 class OutputFiles:
     main_dir: str
@@ -21,7 +58,8 @@ class OutputFiles:
     novel_dir: str
     tmp_dir: str
     main_json_filename: str
-    toc_preffix: str = "toc"
+    main_json_cache_filename: str
+    toc_preffix: str = TOC_PREFFIX
 
     def __init__(self,
                  main_dir: str,
@@ -33,55 +71,158 @@ class OutputFiles:
         self.tmp_dir = f'{self.novel_dir}/tmp'
         self.output_dir = f'{self.novel_dir}/output'
         self.main_json_filename = f'{self.novel_dir}/main.json'
-        os.makedirs(self.novel_dir, exist_ok=True)
-        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.main_json_cache_filename = f'{self.tmp_dir}/main_json.marshal'
+        self.decoded_dir = f'{self.tmp_dir}/decoded'
+        self.toc_dir = f'{self.tmp_dir}/{TOC_DIR}'
+        # The novel and tmp dirs are created as parents of the toc and output dirs
+        try:
+            os.makedirs(self.toc_dir)
+        except FileExistsError:
+            pass
+        else:
+            # Only whoever created the toc dir moves the old toc pages
+            self._move_legacy_toc_files()
         os.makedirs(self.output_dir, exist_ok=True)
 
     def save_to_temp_file(self, path: str, content):
         full_path = Path(self.tmp_dir) / path
-        full_path.parent.mkdir(parents=True, exist_ok=True)
         try:
-            with open(full_path, 'w', encoding='UTF-16') as file:
-                file.write(content)
+            try:
+                full_path.write_text(content, encoding=FILE_ENCODING)
+            except FileNotFoundError:
+                # Only created when missing, instead of checking it on every write
+                full_path.parent.mkdir(parents=True, exist_ok=True)
+                full_path.write_text(content, encoding=FILE_ENCODING)
+        except Exception as e:
+            logger.error('Error saving text file: %s', e)
+
+    def save_chunks_to_temp_file(self, path: str, chunks: Iterable[str]):
+        # Written to a part file first, so a failed download never leaves a truncated temp file
+        full_path = Path(self.tmp_dir) / path
+        part_path = full_path.with_name(f'{full_path.name}.part')
+        try:
+            with open(part_path, 'w', encoding=FILE_ENCODING) as file:
+                for chunk in chunks:
+                    file.write(chunk)
+            os.replace(part_path, full_path)
         except Exception as e:
-            logger.error(f'Error saving text file: {e}')
+            logger.error('Error saving text file: %s', e)
+            part_path.unlink(missing_ok=True)
 
     def load_from_temp_file(self, path: str):
         full_path = Path(self.tmp_dir) / path
         try:
-            if full_path.exists():
-                with open(full_path, 'r', encoding='UTF-16') as file:
-                    logger.debug(f'Content loaded from file: {full_path}')
-                    return file.read()
+            content = decode_file_content(full_path.read_bytes())
+            logger.debug('Content loaded from file: %s', full_path)
+            return content
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            logger.error(f'Error loading temp file: {e}')
+            logger.error('Error loading temp file: %s', e)
         return None
 
+    def get_temp_file_names(self) -> set[str]:
+        # One directory listing to check many temp files
+        with os.scandir(self.tmp_dir) as entries:
+            return {entry.name for entry in entries}
+
+    def load_decoded_chapter(self, html_filename: str, decoder_key: tuple):
+        # Decoded chapter of a temp html, valid while the html file and the decoder are not modified
+        cache_key = self._get_decoded_chapter_key(html_filename, decoder_key)
+        if cache_key is None:
+            return None
+        try:
+            saved_key, decoded_chapter = marshal.loads(
+                (Path(self.decoded_dir) / f'{html_filename}.marshal').read_bytes())
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+        if saved_key != cache_key:
+            return None
+        return decoded_chapter
+
+    def save_decoded_chapter(self, html_filename: str, decoder_key: tuple, decoded_chapter: tuple):
+        cache_key = self._get_decoded_chapter_key(html_filename, decoder_key)
+        if cache_key is None:
+            return
+        full_path = Path(self.decoded_dir) / f'{html_filename}.marshal'
+        try:
+            content = marshal.dumps((cache_key, decoded_chapter))
+            try:
+                full_path.write_bytes(content)
+            except FileNotFoundError:
+                os.makedirs(self.decoded_dir, exist_ok=True)
+                full_path.write_bytes(content)
+        except (OSError, ValueError) as e:
+            logger.debug('Decoded chapter cache not saved: %s', e)
+
+    def _get_decoded_chapter_key(self, html_filename: str, decoder_key: tuple):
+        try:
+            html_stat = (Path(self.tmp_dir) / html_filename).stat()
+        except OSError:
+            return None
+        return (html_stat.st_mtime_ns, html_stat.st_size, *decoder_key)
+
     def clean_temp_file(self, path: str):
         full_path = Path(self.tmp_dir) / path
         try:
-            if full_path.exists():
-                full_path.unlink(missing_ok=True)
+            full_path.unlink(missing_ok=True)
         except Exception as e:
-            logger.error(f'Error cleaning temp file: {e}')
+            logger.error('Error cleaning temp file: %s', e)
 
     def save_novel_json(self, main_data: dict):
+        # Write to a temp file and replace, so a failed save doesn't leave a truncated json
+        tmp_path = Path(f'{self.main_json_filename}.tmp')
         try:
-            with open(self.main_json_filename, 'w', encoding='UTF-16') as file:
-                json.dump(main_data, file, ensure_ascii=False, indent=4)
+            tmp_path.write_bytes(orjson.dumps(main_data, option=orjson.OPT_INDENT_2))
+            os.replace(tmp_path, self.main_json_filename)
         except Exception as e:
-            logger.error(f'Error saving main json file: {e}')
+            logger.error('Error saving main json file: %s', e)
 
-    def load_novel_json(self):
+    def load_novel_json(self) -> dict:
         full_path = Path(self.main_json_filename)
         try:
-            if full_path.exists():
-                with open(full_path, 'r', encoding='UTF-16') as file:
-                    main_json = file.read()
-                    return main_json
+            json_stat = full_path.stat()
+        except FileNotFoundError:
+            return None
+        main_json = self._load_novel_json_cache(json_stat)
+        if main_json is not None:
+            return main_json
+        try:
+            main_json = orjson.loads(self._read_novel_json_bytes(full_path))
+        except FileNotFoundError:
+            return None
+        except orjson.JSONDecodeError as e:
+            logger.error('Main json file is not a valid json: %s', e)
+            return None
         except Exception as e:
-            logger.error(f'Error loading main json file: {e}')
-        return None
+            logger.error('Error loading main json file: %s', e)
+            return None
+        self._save_novel_json_cache(json_stat, main_json)
+        return main_json
+
+    def _read_novel_json_bytes(self, full_path: Path) -> bytes:
+        content = full_path.read_bytes()
+        if content.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            return decode_file_content(content).encode(FILE_ENCODING)
+        return content
+
+    def _load_novel_json_cache(self, json_stat: os.stat_result):
+        # Already parsed main json, valid while the json file is not modified
+        try:
+            mtime_ns, size, main_json = marshal.loads(
+                Path(self.main_json_cache_filename).read_bytes())
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+        if mtime_ns != json_stat.st_mtime_ns or size != json_stat.st_size:
+            return None
+        return main_json
+
+    def _save_novel_json_cache(self, json_stat: os.stat_result, main_json: dict):
+        try:
+            Path(self.main_json_cache_filename).write_bytes(
+                marshal.dumps((json_stat.st_mtime_ns, json_stat.st_size, main_json)))
+        except (OSError, ValueError) as e:
+            logger.debug('Main json cache not saved: %s', e)
 
     def save_cover_img(self, img_path: str):
         filename = os.path.basename(img_path)
@@ -91,60 +232,88 @@ class OutputFiles:
             shutil.copy(img_path, destination_path)
             return filename
         except Exception as e:
-            logger.error(f'Error copying the cover image: {e}')
+            logger.error('Error copying the cover image: %s', e)
             return None
 
     def load_cover_img(self, img_path: str):
         cover_img_path = Path(self.novel_dir) / img_path
         try:
-            with open(cover_img_path, 'rb') as file:
-                content = file.read()
-                return content
+            return cover_img_path.read_bytes()
         except Exception as e:
-            logger.error(f'Error loading cover image: {e}')
+            logger.error('Error loading cover image: %s', e)
             return None
 
     def get_output_dir(self):
         return self.output_dir
 
+    def save_book(self, book: 'epub.EpubBook', filename: str):
+        from ebooklib import epub
+        book_path = Path(self.output_dir) / filename
+        tmp_path = book_path.with_suffix(book_path.suffix + '.tmp')
+        try:
+            epub.write_epub(str(tmp_path), book, {'compresslevel': EPUB_COMPRESS_LEVEL})
+            os.replace(tmp_path, book_path)
+            return str(book_path)
+        except Exception as e:
+            logger.error('Error saving epub file: %s', e)
+            tmp_path.unlink(missing_ok=True)
+            return None
+
     def clear_toc(self):
-        toc_pos = 0
-        toc_exists = True
-        while toc_exists:
-            toc_filename = f"{self.toc_preffix}_{toc_pos}.html"
-            toc_path = Path(self.tmp_dir) / toc_filename
-            toc_exists = toc_path.exists()
-            if toc_exists:
-                toc_path.unlink()
-                toc_pos += 1
-                
-                
+        for _, toc_path in self._get_toc_files():
+            toc_path.unlink(missing_ok=True)
+
     def add_toc(self, content: str):
-        toc_pos = 0
-        toc_exists = True
-        while toc_exists:
-            toc_filename = f"{self.toc_preffix}_{toc_pos}.html"
-            toc_path = Path(self.tmp_dir) / toc_filename
-            toc_exists = toc_path.exists()
-            if toc_exists:
-                toc_pos += 1
-        try:
-            with open(toc_path, 'w', encoding='UTF-16') as file:
-                file.write(content)
+        toc_path = self._get_new_toc_path()
+        try:
+            toc_path.write_text(content, encoding=FILE_ENCODING)
+        except Exception as e:
+            logger.error('Error saving text file: %s', e)
+
+    def add_toc_from_file(self, toc_file: BinaryIO, errors: str = 'replace'):
+        toc_path = self._get_new_toc_path()
+        try:
+            with map_file(toc_file) as toc_bytes:
+                try:
+                    # Valid UTF-8 is written as is, without going through the text io layer
+                    str(toc_bytes, FILE_ENCODING)
+                except UnicodeDecodeError:
+                    toc_bytes = str(toc_bytes, FILE_ENCODING, errors).encode(FILE_ENCODING)
+                toc_path.write_bytes(toc_bytes)
         except Exception as e:
-            logger.error(f'Error saving text file: {e}')
+            logger.error('Error saving text file: %s', e)
+
+    def _get_new_toc_path(self) -> Path:
+        toc_files = self._get_toc_files()
+        toc_pos = toc_files[-1][0] + 1 if toc_files else 0
+        toc_filename = f"{self.toc_preffix}_{toc_pos}.html"
+        return Path(self.toc_dir) / toc_filename
 
     def get_toc(self, pos_idx: int):
         toc_filename = f"{self.toc_preffix}_{pos_idx}.html"
-        return self.load_from_temp_file(toc_filename)
+        return self.load_from_temp_file(f'{TOC_DIR}/{toc_filename}')
 
-    def get_all_toc(self):
-        pos = 0
-        tocs = []
-        while True:
-            toc_content = self.get_toc(pos)
+    def get_all_toc(self) -> Iterable[str]:
+        # Read one page at a time, so each page can be freed once it is decoded
+        for _, toc_path in self._get_toc_files():
+            toc_content = self.load_from_temp_file(f'{TOC_DIR}/{toc_path.name}')
             if toc_content:
-                tocs.append(toc_content)
-                pos += 1
-            else:
-                return tocs
+                yield toc_content
+
+    def _get_toc_files(self) -> list[tuple[int, Path]]:
+        # One directory listing instead of checking each toc position
+        toc_files = []
+        with os.scandir(self.toc_dir) as entries:
+            for entry in entries:
+                match = TOC_FILE_RE.match(entry.name)
+                if match and entry.is_file():
+                    toc_files.append((int(match.group(1)), Path(entry.path)))
+        toc_files.sort()
+        return toc_files
+
+    def _move_legacy_toc_files(self):
+        # Older versions saved the toc pages in the tmp dir, numbered from 0
+        toc_pos = 0
+        while (legacy_path := Path(self.tmp_dir) / f'{self.toc_preffix}_{toc_pos}.html').is_file():
+            os.replace(legacy_path, Path(self.toc_dir) / legacy_path.name)
+            toc_pos += 1
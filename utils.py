@@ -1,11 +1,18 @@
 from output_file import OutputFiles
 import custom_request
 import hashlib
-from urllib.parse import urlparse
+from functools import lru_cache
+from urllib.parse import urlparse, urlsplit
 import re
 import unicodedata
 
+FILE_NAME_NOT_ALLOWED_RE = re.compile(r'[^a-zA-Z0-9_\-]')
+TITLE_SEPARATORS_RE = re.compile(r'[\s\-]+')
+TITLE_NOT_ALLOWED_RE = re.compile(r'[^a-zA-Z0-9_]')
 
+
+# The same links are named several times on a run, from the prefetch and from each scrap
+@lru_cache(maxsize=8192)
 def generate_file_name_from_url(url: str) -> str:
     # Parsea URL
     parsed_url = urlparse(url)
@@ -16,7 +23,7 @@ def generate_file_name_from_url(url: str) -> str:
     base_name = '_'.join(last_two_parts) if last_two_parts else 'index'
 
     # Replace not allowed characters
-    safe_base_name = re.sub(r'[^a-zA-Z0-9_\-]', '_', base_name)
+    safe_base_name = FILE_NAME_NOT_ALLOWED_RE.sub('_', base_name)
     # Limit the path length
     if len(safe_base_name) > 50:
         safe_base_name = safe_base_name[:50]
@@ -26,12 +33,13 @@ def generate_file_name_from_url(url: str) -> str:
     return filename
 
 
+@lru_cache(maxsize=8192)
 def generate_epub_file_name_from_title(title: str) -> str:
     normalized_title = unicodedata.normalize(
         'NFKD', title).encode('ASCII', 'ignore').decode('ASCII')
     normalized_title = normalized_title.lower()
-    normalized_title = re.sub(r'[\s\-]+', '_', normalized_title)
-    sanitized_title = re.sub(r'[^a-zA-Z0-9_]', '', normalized_title)
+    normalized_title = TITLE_SEPARATORS_RE.sub('_', normalized_title)
+    sanitized_title = TITLE_NOT_ALLOWED_RE.sub('', normalized_title)
     max_length = 50
     if len(sanitized_title) > max_length:
         sanitized_title = sanitized_title[:max_length]
@@ -41,17 +49,17 @@ def generate_epub_file_name_from_title(title: str) -> str:
     return filename
 
 
-def obtain_host(url: str):
-    try:
-        host = url.split(':')[1]
-    except Exception:
-        pass
-    while host.startswith('/'):
-        host = host[1:]
+@lru_cache(maxsize=1024)
+def obtain_host(url: str) -> str:
+    # Most of the links of a novel share the host.
+    # The port is kept since the host is also used to build the chapter links
+    host = urlsplit(url).netloc.rpartition('@')[2].lower()
+    return host.removeprefix('www.')
 
-    host = host.split('/')[0].replace('www.', '')
 
-    return host
+def remove_duplicates_in_list(items: list) -> list:
+    # Keeps the first occurrence of each item, so the order of the list is kept
+    return list(dict.fromkeys(items))
 
 
 def create_volume_id(n: int):
@@ -77,3 +85,25 @@ def get_url_or_temp_file(output_file: OutputFiles,
     if temp_file_path:
         output_file.save_to_temp_file(temp_file_path, content)
     return content, temp_file_path
+
+
+def fetch_urls_to_temp_files(output_file: OutputFiles,
+                             urls: list[str],
+                             reload: bool = False,
+                             max_workers: int = 8,
+                             delay: float = 0,
+                             flaresolver: bool = True):
+    if not reload:
+        temp_file_names = output_file.get_temp_file_names()
+        urls = [url for url in urls
+                if generate_file_name_from_url(url) not in temp_file_names]
+    if not urls:
+        return
+
+    # Each page is written to its temp file while it downloads
+    custom_request.stream_html_contents(
+        urls,
+        lambda url, chunks: output_file.save_chunks_to_temp_file(generate_file_name_from_url(url), chunks),
+        max_workers=max_workers,
+        delay=delay,
+        flaresolver=flaresolver)